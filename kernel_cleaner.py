@@ -11,17 +11,35 @@ Auteur: Nannouche
 
 """
 
+import functools
 import os
 import re
+import signal
 import subprocess
 import sys
-from typing import List, Tuple, Optional
+from typing import Dict, Iterator, List, Tuple, Optional
 import argparse
 
+DPKG_STATUS_PATH = '/var/lib/dpkg/status'
+OSRELEASE_PATH = '/proc/sys/kernel/osrelease'
+
+# Préfixes testés avant toute analyse plus coûteuse (split, regex, décodage)
+_KERNEL_STANZA_PREFIX = b'Package: linux-'
+_KERNEL_IMAGE_PREFIX = 'linux-image-'
+# Équivalent de l'état "ii" de dpkg -l (exclut notamment les packages "hold")
+_STATUS_INSTALLED = b'Status: install ok installed'
+_KERNEL_PREFIXES = ('linux-image-', 'linux-headers-', 'linux-modules-')
+
+# Version A.B.C-D, seule ou dans un nom de package (linux-image-A.B.C-D-amd64)
+_KERNEL_VERSION_RE = re.compile(r'(\d+)\.(\d+)\.(\d+)-(\d+)')
+
 class KernelCleaner:
     def __init__(self):
         self.current_kernel = self.get_current_kernel()
         self.verbose = False
+        self._dpkg_cache = None
+        self._kernel_index = None
+        self._installed_kernels = None
         
     def log(self, message: str, level: str = "INFO"):
         """Affiche un message avec un niveau de log"""
@@ -31,45 +49,175 @@ class KernelCleaner:
     def get_current_kernel(self) -> str:
         """Récupère la version du noyau actuellement en cours d'utilisation"""
         try:
-            result = subprocess.run(['uname', '-r'], capture_output=True, text=True, check=True)
-            return result.stdout.strip()
-        except subprocess.CalledProcessError:
+            with open(OSRELEASE_PATH) as f:
+                return f.read().strip()
+        except OSError:
+            pass
+        
+        # Hors Linux (ou /proc absent): appel système uname(2)
+        try:
+            return os.uname().release
+        except (AttributeError, OSError):
             raise RuntimeError("Impossible de déterminer le noyau actuel")
     
-    def get_installed_kernels(self) -> List[str]:
-        """Récupère la liste des noyaux installés"""
-        try:
-            result = subprocess.run(['dpkg', '-l'], capture_output=True, text=True, check=True)
-            kernels = []
+    def _read_dpkg_status(self) -> List[str]:
+        """Lit /var/lib/dpkg/status et retourne les packages linux-* installés"""
+        with open(DPKG_STATUS_PATH, 'rb') as f:
+            data = f.read()
+        
+        packages = []
+        for stanza in data.split(b'\n\n'):
+            # Le champ Package est toujours le premier d'une entrée
+            stanza = stanza.lstrip(b'\n')
+            if not stanza.startswith(_KERNEL_STANZA_PREFIX):
+                continue
             
-            for line in result.stdout.split('\n'):
-                if 'linux-image-' in line and line.startswith('ii'):
-                    parts = line.split()
-                    if len(parts) >= 2:
-                        package = parts[1]
-                        # Extraire la version du noyau du nom du package
-                        match = re.search(r'linux-image-(\d+\.\d+\.\d+-\d+)', package)
-                        if match:
-                            kernel_version = match.group(1)
-                            kernels.append(kernel_version)
+            fields = stanza.split(b'\n')
+            for field in fields:
+                if field.startswith(b'Status: '):
+                    if field.rstrip() == _STATUS_INSTALLED:
+                        packages.append(fields[0][len(b'Package: '):].strip().decode())
+                    break
+        
+        return packages
+    
+    @staticmethod
+    def _run_capture(argv: List[str]) -> Iterator[str]:
+        """Lance une commande via posix_spawn et parcourt sa sortie ligne par ligne"""
+        read_fd, write_fd = os.pipe()
+        try:
+            pid = os.posix_spawnp(argv[0], argv, os.environ, file_actions=[
+                (os.POSIX_SPAWN_DUP2, write_fd, 1),
+                (os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0),
+            ])
+        except OSError:
+            os.close(read_fd)
+            raise
+        finally:
+            os.close(write_fd)
+        
+        finished = False
+        try:
+            with os.fdopen(read_fd) as stdout:
+                yield from stdout
+            finished = True
+        finally:
+            # Lecture interrompue par l'appelant: arrêter la commande
+            if not finished:
+                os.kill(pid, signal.SIGTERM)
+            _, status = os.waitpid(pid, 0)
+        
+        returncode = os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, argv)
+    
+    def _dpkg_query(self) -> List[str]:
+        """Retourne les packages linux-* installés selon `dpkg-query`"""
+        packages = []
+        seen_linux = False
+        
+        # Sortie minimale "état<TAB>nom", sans la mise en forme en tableau de dpkg -l
+        lines = self._run_capture(['dpkg-query', '-W', '-f=${db:Status-Abbrev}\t${Package}\n'])
+        for line in lines:
+            # L'état fait 3 caractères: le nom commence en colonne 4 ("ii \tnom")
+            if line.startswith('linux-', 4):
+                seen_linux = True
+                status, _, package = line.rstrip('\n').partition('\t')
+                # "ii " exactement, comme "install ok installed" dans le fichier status
+                if status == 'ii ':
+                    packages.append(package)
+            elif seen_linux:
+                # dpkg-query est trié par nom: plus aucun package linux-* à venir
+                lines.close()
+                break
+        
+        return packages
+    
+    def _iter_installed_packages(self) -> Iterator[str]:
+        """Parcourt les packages linux-* installés, mis en cache au premier appel"""
+        if self._dpkg_cache is None:
+            try:
+                self._dpkg_cache = self._read_dpkg_status()
+            except OSError as e:
+                self.log(f"Lecture de {DPKG_STATUS_PATH} impossible ({e}), utilisation de dpkg-query")
+                self._dpkg_cache = self._dpkg_query()
+        return iter(self._dpkg_cache)
+    
+    def _scan_kernel_packages(self) -> Dict[str, List[str]]:
+        """Indexe en une seule passe les packages du noyau par version installée"""
+        if self._kernel_index is not None:
+            return self._kernel_index
+        
+        try:
+            packages_by_version = {}
+            image_versions = set()
             
-            return sorted(set(kernels))
+            for package in self._iter_installed_packages():
+                # Packages liés au noyau
+                if not package.startswith(_KERNEL_PREFIXES):
+                    continue
+                match = _KERNEL_VERSION_RE.search(package)
+                if not match:
+                    continue
+                kernel_version = match.group(0)
+                packages_by_version.setdefault(kernel_version, []).append(package)
+                
+                # Seuls les linux-image-<version> définissent un noyau installé
+                if match.start() == len(_KERNEL_IMAGE_PREFIX) and package.startswith(_KERNEL_IMAGE_PREFIX):
+                    image_versions.add(kernel_version)
         except subprocess.CalledProcessError:
             raise RuntimeError("Impossible de lister les noyaux installés")
+        
+        self._kernel_index = {v: packages_by_version[v] for v in image_versions}
+        return self._kernel_index
     
-    def parse_kernel_version(self, version: str) -> Tuple[int, int, int, int]:
-        """Parse une version de noyau en tuple pour comparaison"""
-        match = re.match(r'(\d+)\.(\d+)\.(\d+)-(\d+)', version)
+    def get_installed_kernels(self) -> List[str]:
+        """Récupère la liste des noyaux installés (calculée une seule fois)"""
+        if self._installed_kernels is None:
+            self._installed_kernels = sorted(self._scan_kernel_packages().keys())
+        return self._installed_kernels
+    
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def parse_kernel_version(version: str) -> Tuple[int, int, int, int]:
+        """Parse une version de noyau en tuple pour comparaison (résultat mis en cache)"""
+        try:
+            a, b, rest = version.split('.', 2)
+            c, d = rest.split('-', 1)
+            return (int(a), int(b), int(c), int(d))
+        except ValueError:
+            pass
+        
+        # Format inhabituel (suffixe, etc.): repli sur l'expression régulière
+        match = _KERNEL_VERSION_RE.match(version)
         if match:
             return tuple(map(int, match.groups()))
         raise ValueError(f"Format de version invalide: {version}")
     
+    def is_current_kernel(self, kernel_version: str) -> bool:
+        """Indique si une version installée (ex: 6.1.0-13) est le noyau en cours (ex: 6.1.0-13-amd64)"""
+        return self.current_kernel == kernel_version or self.current_kernel.startswith(kernel_version + '-')
+    
     def find_oldest_removable_kernel(self) -> Optional[str]:
         """Trouve le plus ancien noyau qui peut être supprimé"""
+        # Comptage rapide: avec au plus deux noyaux (actuel + sauvegarde),
+        # inutile d'extraire et de comparer les versions
+        start = len(_KERNEL_IMAGE_PREFIX)
+        try:
+            image_count = sum(1 for package in self._iter_installed_packages()
+                              if package.startswith(_KERNEL_IMAGE_PREFIX) and package[start:start + 1].isdigit())
+        except subprocess.CalledProcessError:
+            raise RuntimeError("Impossible de lister les noyaux installés")
+        if image_count == 0:
+            return None
+        if image_count < 3:
+            self.log("Seul le noyau actuel et un noyau de sauvegarde sont installés")
+            return None
+        
         installed_kernels = self.get_installed_kernels()
         
         # Retirer le noyau actuel de la liste
-        removable_kernels = [k for k in installed_kernels if k != self.current_kernel]
+        removable_kernels = [k for k in installed_kernels if not self.is_current_kernel(k)]
         
         if not removable_kernels:
             return None
@@ -79,32 +227,16 @@ class KernelCleaner:
             self.log("Seul le noyau actuel et un noyau de sauvegarde sont installés")
             return None
         
-        # Trier par version et prendre le plus ancien
+        # Prendre le plus ancien (pas besoin de trier toute la liste)
         try:
-            removable_kernels.sort(key=self.parse_kernel_version)
-            return removable_kernels[0]
+            return min(removable_kernels, key=self.parse_kernel_version)
         except ValueError as e:
             self.log(f"Erreur lors du tri des versions: {e}", "ERROR")
             return None
     
     def get_kernel_packages(self, kernel_version: str) -> List[str]:
         """Récupère tous les packages associés à une version de noyau"""
-        try:
-            result = subprocess.run(['dpkg', '-l'], capture_output=True, text=True, check=True)
-            packages = []
-            
-            for line in result.stdout.split('\n'):
-                if line.startswith('ii') and kernel_version in line:
-                    parts = line.split()
-                    if len(parts) >= 2:
-                        package = parts[1]
-                        # Packages liés au noyau
-                        if any(prefix in package for prefix in ['linux-image-', 'linux-headers-', 'linux-modules-']):
-                            packages.append(package)
-            
-            return packages
-        except subprocess.CalledProcessError:
-            raise RuntimeError("Impossible de lister les packages du noyau")
+        return list(self._scan_kernel_packages().get(kernel_version, []))
     
     def remove_kernel(self, kernel_version: str, dry_run: bool = False) -> bool:
         """Supprime un noyau et ses packages associés"""
@@ -129,7 +261,12 @@ class KernelCleaner:
             cmd = ['sudo', 'apt-get', 'remove', '--purge', '-y'] + packages
             self.log(f"Exécution: {' '.join(cmd)}")
             
-            result = subprocess.run(cmd, capture_output=True, text=True)
+            # Sortie transmise directement au terminal (progression visible)
+            result = subprocess.run(cmd, check=False)
+            # La liste des packages a changé
+            self._dpkg_cache = None
+            self._kernel_index = None
+            self._installed_kernels = None
             
             if result.returncode == 0:
                 self.log(f"Noyau {kernel_version} supprimé avec succès")
@@ -140,7 +277,7 @@ class KernelCleaner:
                 
                 return True
             else:
-                self.log(f"Erreur lors de la suppression: {result.stderr}", "ERROR")
+                self.log(f"Erreur lors de la suppression: apt-get a retourné le code {result.returncode}", "ERROR")
                 return False
                 
         except subprocess.CalledProcessError as e:
@@ -149,26 +286,36 @@ class KernelCleaner:
     
     def confirm_removal(self, kernel_version: str, packages: List[str]) -> bool:
         """Demande confirmation avant suppression"""
-        print(f"\n⚠️  CONFIRMATION REQUISE ⚠️")
-        print(f"Noyau actuel: {self.current_kernel}")
-        print(f"Noyau à supprimer: {kernel_version}")
-        print(f"Packages à supprimer: {len(packages)}")
-        
-        for pkg in packages:
-            print(f"  - {pkg}")
+        lines = [
+            f"\n⚠️  CONFIRMATION REQUISE ⚠️\n",
+            f"Noyau actuel: {self.current_kernel}\n",
+            f"Noyau à supprimer: {kernel_version}\n",
+            f"Packages à supprimer: {len(packages)}\n",
+        ]
+        lines.extend(f"  - {pkg}\n" for pkg in packages)
+        # Une seule écriture pour tout le récapitulatif
+        sys.stdout.write(''.join(lines))
         
         response = input("\nÊtes-vous sûr de vouloir supprimer ce noyau? (oui/non): ").lower().strip()
         return response in ['oui', 'o', 'yes', 'y']
     
     def show_status(self):
         """Affiche le statut des noyaux installés"""
-        print(f"Noyau actuel: {self.current_kernel}")
-        print(f"Noyaux installés:")
+        lines = [
+            f"Noyau actuel: {self.current_kernel}\n",
+            f"Noyaux installés:\n",
+        ]
         
         installed_kernels = self.get_installed_kernels()
-        for kernel in sorted(installed_kernels, key=self.parse_kernel_version, reverse=True):
-            status = " (ACTUEL)" if kernel == self.current_kernel else ""
-            print(f"  - {kernel}{status}")
+        # Chaque version n'est analysée qu'une fois avant le tri
+        parsed = [(self.parse_kernel_version(k), k) for k in installed_kernels]
+        parsed.sort(reverse=True)
+        for _, kernel in parsed:
+            status = " (ACTUEL)" if self.is_current_kernel(kernel) else ""
+            lines.append(f"  - {kernel}{status}\n")
+        
+        # Écriture groupée, avant les éventuels logs de la recherche ci-dessous
+        sys.stdout.write(''.join(lines))
         
         oldest = self.find_oldest_removable_kernel()
         if oldest: